@@ -3,33 +3,32 @@
 
 from __future__ import print_function
 
+import os
 import re
 import sys
-import time
 from Queue import Queue
 from collections import deque
 
 from twisted.words.protocols import irc
 from twisted.internet import protocol, reactor
 from twisted.logger import textFileLogObserver, globalLogBeginner, Logger
-globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
 
 from twisted.words.protocols.irc import assembleFormattedText
 from twisted.words.protocols.irc import attributes as A
 
 
-from github_events import GithubArchiveEventsParser
+from event_bus import BusSubscriber
+from event_trace import TraceLog
 
 log = Logger(namespace="CHATBOT")
-log.info("Started")
 
 
 commands = {}
 JOIN_COMMENT = (
     "I'm back!\n"
     "I recently learned to handle delete events. Comments and feedback go to "
-    "TLE.\nI'll show you the last event from github, since I don't know how "
-    "long I was out."
+    "TLE.\nI'll show you the latest few github events I missed while I was "
+    "out, or the last one if I don't know what I missed."
     )
 
 class PelsBot(irc.IRCClient):
@@ -52,15 +51,32 @@ class PelsBot(irc.IRCClient):
         # init stuff here
         self.line_queue = Queue()
         for line in JOIN_COMMENT.split('\n'):
-            self.line_queue.put(line)
+            self.line_queue.put((line, None))
         self.line_history = deque(maxlen=5)
         log.info("Joined {channel}", channel=channel)
 
-        # Make the client known to the github
-        self.event_parser = GithubArchiveEventsParser(self.factory.repo, reactor, self)
-        self.event_parser.watch_for_events()
+        # Make the client known to the github, either through the parser
+        # run by the factory or through a poller process on the bus
+        if self.factory.bus is None:
+            self.factory.start_events()
+            self.event_parser = self.factory.event_parser
+            self.factory.attach(self)
+        else:
+            self.event_parser = self.factory.bus
+            self.event_parser.attach(self)
         self._send_line()
 
+    def connectionLost(self, reason):
+        # The lines still queued will never reach the channel
+        for _, trace in list(getattr(self, 'line_queue', Queue()).queue):
+            if trace is not None:
+                self.factory.trace_log.drop(trace, 'connection lost')
+        if self.factory.bus is None:
+            self.factory.detach()
+        else:
+            self.factory.bus.detach()
+        irc.IRCClient.connectionLost(self, reason)
+
     def privmsg(self, user, channel, msg):
         """Recieved msg"""
         log.info("Got message {msg}", msg=msg)
@@ -77,52 +93,61 @@ class PelsBot(irc.IRCClient):
             if command_method:
                 command_method(user, command)
             else:
-                self.line_queue.put("{}: Unknown command: '{}' try 'help'".format(user, command))            
+                self.line_queue.put(("{}: Unknown command: '{}' try 'help'".format(user, command), None))            
         else:
-            self.line_queue.put("{}: I don't understand".format(user))
+            self.line_queue.put(("{}: I don't understand".format(user), None))
         #self.msg(self.factory.channel, msg)
 
     def look_for_key_words(self, msg):
         """Look for keywords in a msg"""
-        match = ISS_RE.match(msg)
-        if match:
-            issue_number = int(match.group(1))
-            log.debug("Found issue number {issue}", issue=issue_number)
-            self.event_parser.show_issue(issue_number)
+        issue_numbers = [int(number) for number in ISS_RE.findall(msg)]
+        if issue_numbers:
+            log.debug("Found issue numbers {issues}", issues=issue_numbers)
+            self.event_parser.show_issues(issue_numbers)
 
-    def send_multiline_msg(self, msg, prefix=''):
+    def send_multiline_msg(self, msg, prefix='', trace=None):
         log.debug("Should send multiline message:")
-        for line in msg.split('\n'):
+        lines = msg.split('\n')
+        if trace is not None:
+            trace.enqueued = self.factory.reactor.seconds()
+            trace.lines = len(lines)
+        for line in lines:
             log.debug("# {prefix}{line}", prefix=prefix, line=line)
-            self.line_queue.put(prefix + line)
+            self.line_queue.put((prefix + line, trace))
 
     def _send_line(self):
+        clock = self.factory.reactor
         # Nothing to send
         if self.line_queue.qsize() == 0:
-            reactor.callLater(0.1, self._send_line)
+            clock.callLater(0.1, self._send_line)
             return
 
-        now = time.time()
+        now = clock.seconds()
         if len(self.line_history) < 5 or now - self.line_history[0] > 10:
             # Burst allowed
-            msg = self.line_queue.get()
+            msg, trace = self.line_queue.get()
             log.debug("Burst    {msg}", msg=repr(msg))
         else:
             if now - self.line_history[-1] > 1:
-                msg = self.line_queue.get()
+                msg, trace = self.line_queue.get()
                 log.debug("Throttled{msg}", msg=repr(msg))
             else:
                 # delay this line until 1 since last
-                reactor.callLater(now - self.line_history[-1], self._send_line)
+                clock.callLater(now - self.line_history[-1], self._send_line)
                 return
 
         self.say(self.factory.channel, msg)
         self.line_history.append(now)
-        reactor.callLater(0.2, self._send_line)
+        if trace is not None and not trace.dropped:
+            if self.transport.disconnecting:
+                self.factory.trace_log.drop(trace, 'connection lost')
+            elif trace.line_sent(now):
+                self.factory.trace_log.complete(trace)
+        clock.callLater(0.2, self._send_line)
 
     def say_to_user(self, user, reply):
         """Convinience say to user command"""
-        self.line_queue.put(user + ": " + reply)
+        self.line_queue.put((user + ": " + reply, None))
 
     @command
     def command_hi(self, user, command):
@@ -146,7 +171,7 @@ class PelsBot(irc.IRCClient):
         msg = (
             'I\'m the friendly bot for {}. '
             'I will keep you updated on repository events and I understand the '
-            'commands: hi, help and issue'
+            'commands: hi, help, issue and latency'
         ).format(self.factory.repo)
         self.say_to_user(user, msg)
 
@@ -160,6 +185,11 @@ class PelsBot(irc.IRCClient):
         issue_number = match.group(1)
         self.event_parser.show_issue(issue_number)
 
+    @command
+    def command_latency(self, user, command):
+        """Shows how long recent events took from github to here"""
+        self.say_to_user(user, self.factory.trace_log.summary())
+
     def say(self, *args, **kwargs):
         log.debug("say {args} {kwargs}", args=repr(args), kwargs=repr(kwargs))
         irc.IRCClient.say(self, *args, **kwargs)
@@ -169,10 +199,55 @@ class PelsBot(irc.IRCClient):
 class PelsBotFactory(protocol.ClientFactory):
     protocol = PelsBot
 
-    def __init__(self, channel, repo, nickname='GithubBot'):
+    def __init__(self, channel, repo, nickname='GithubBot', bus=None, reactor=reactor,
+                 trace_log=None, snapshot_dir=None):
         self.channel = channel
         self.repo = repo
         self.nickname = nickname
+        self.bus = bus
+        # Completed event traces, kept here so they survive reconnects
+        self.trace_log = trace_log or TraceLog()
+        # Used for timing the sending of lines, can be swapped for a Clock
+        self.reactor = reactor
+        self.snapshot_dir = snapshot_dir
+        self.event_parser = None
+        self.chatbot = None
+        # Messages from the parser while no chatbot is connected
+        self.pending = deque(maxlen=100)
+
+    def start_events(self):
+        """Start watching events and warming up the issue cache
+
+        Called when the reactor starts, so the first poll runs in parallel
+        with the IRC connect, instead of after the channel is joined.
+        """
+        if self.event_parser is not None:
+            return
+        # Imported here, so the web client is only loaded if it is used
+        from github_events import GithubArchiveEventsParser
+        self.event_parser = GithubArchiveEventsParser(
+            self.repo, self.reactor, self, self.snapshot_dir
+        )
+        self.event_parser.watch_for_events()
+        self.event_parser.warm_up()
+
+    def attach(self, chatbot):
+        """Deliver messages to chatbot, starting with the pending ones"""
+        self.chatbot = chatbot
+        while self.pending:
+            msg, prefix, trace = self.pending.popleft()
+            chatbot.send_multiline_msg(msg, prefix, trace)
+
+    def detach(self):
+        """Stop delivering messages, e.g. when the connection is lost"""
+        self.chatbot = None
+
+    def send_multiline_msg(self, msg, prefix='', trace=None):
+        """Pass a message from the parser on to the chatbot, if connected"""
+        if self.chatbot is None:
+            self.pending.append((msg, prefix, trace))
+        else:
+            self.chatbot.send_multiline_msg(msg, prefix, trace)
 
     def clientConnectionLost(self, connector, reason):
         log.debug("Lost connection {reason}, reconnecting", reason=reason)
@@ -183,13 +258,31 @@ class PelsBotFactory(protocol.ClientFactory):
 
         
 if __name__ == "__main__":
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
+    log.info("Started")
     log.debug(str(sys.argv))
-    _, bot_name, channel, repo = sys.argv
+    # Optionally, a 5th argument "host:port" of a poller process (see
+    # event_bus.py) to get the events from, instead of polling in-process
+    _, bot_name, channel, repo = sys.argv[:4]
+    bus = None
+    if len(sys.argv) > 4:
+        host, port = sys.argv[4].split(':')
+        bus = BusSubscriber(repo, channel, host, int(port))
+        reactor.listenUDP(0, bus, interface='127.0.0.1')
+    # Completed event traces are written as JSON lines to EVENT_TRACE_LOG
+    trace_log = TraceLog(os.environ.get('EVENT_TRACE_LOG'))
+    # The warm state is kept between runs in EVENT_SNAPSHOT_DIR
+    snapshot_dir = os.environ.get('EVENT_SNAPSHOT_DIR')
     COMMAND_RE = re.compile('{}:? *(.*)'.format(bot_name), re.IGNORECASE)
-    ISS_RE = re.compile('.*#(\d+).*', re.DOTALL)
+    ISS_RE = re.compile('#(\d+)')
     ISS_COMMAND_RE = re.compile('issue #?(\d+)')
 
-    reactor.connectTCP('irc.freenode.net', 6667, PelsBotFactory(channel, repo, bot_name))
+    factory = PelsBotFactory(
+        channel, repo, bot_name, bus, trace_log=trace_log, snapshot_dir=snapshot_dir
+    )
+    if bus is None:
+        reactor.callWhenRunning(factory.start_events)
+    reactor.connectTCP('irc.freenode.net', 6667, factory)
     
     try:
         log.info('before reactor')
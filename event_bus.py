@@ -0,0 +1,327 @@
+"""Local UDP bus between github poller processes and IRC emitter processes
+
+A poller process runs one GithubArchiveEventsParser per repository and
+publishes the formatted messages on a UDP port. IRC emitter processes
+(PelsBot) subscribe to a single repository on that port and relay what
+they receive to their channel. Issue lookups requested in a channel are
+sent back over the bus and answered by the poller.
+
+Every datagram is a JSON object with a "type" key:
+
+ * "subscribe", "repo", "channel", "last_seq": sent periodically from
+   emitter to poller and after every feed event, with the "seq" of the last
+   feed event received, or null if none since the emitter started
+ * "issue", "repo", "number": emitter asks the poller to look up an issue
+ * "issues", "repo", "numbers": emitter asks for a batch of issues
+ * "message", "repo", "msg", "prefix", "trace", "seq": poller publishes a
+   message, with the latency trace of the event, if any
+
+Feed events are published to all subscribers of the repo, replies to
+issue lookups only to the emitter that asked. Feed events carry a "seq"
+of [poller session, number] and the poller keeps the last BACKLOG_SIZE
+of them. When an emitter (re)subscribes, e.g. after a restart, it is sent
+the ones its channel has not received yet, so no announcements are lost
+while no emitter listens.
+
+Repositories can be sharded by running several pollers on different
+ports, each with a subset of the repositories.
+
+Run a poller with:
+
+    python event_bus.py PORT owner/repo [owner/repo ...]
+"""
+
+from __future__ import print_function
+
+import json
+import socket
+import time
+from collections import deque
+
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from event_trace import EventTrace
+
+log = Logger(namespace="BUS")
+
+# Emitters re-subscribe every SUBSCRIBE_INTERVAL seconds and the poller
+# forgets subscribers it has not heard from in SUBSCRIBER_TIMEOUT seconds,
+# so either side can be restarted independently
+SUBSCRIBE_INTERVAL = 30
+SUBSCRIBER_TIMEOUT = 90
+# The number of feed events per repo kept for emitters that subscribe later
+BACKLOG_SIZE = 20
+
+
+class RepoPublisher(object):
+    """Stand-in for the chatbot that publishes a repos messages on the bus"""
+
+    def __init__(self, bus, repo):
+        self.bus = bus
+        self.repo = repo
+
+    def send_multiline_msg(self, msg, prefix='', trace=None):
+        """Publish a message to all subscribers of the repo"""
+        self.bus.publish(self.repo, msg, prefix, trace)
+
+
+class ReplyPublisher(object):
+    """Stand-in for the chatbot that replies to a single emitter on the bus"""
+
+    def __init__(self, bus, repo, addr):
+        self.bus = bus
+        self.repo = repo
+        self.addr = addr
+
+    def send_multiline_msg(self, msg, prefix='', trace=None):
+        """Send a message to the emitter only"""
+        self.bus.reply(self.repo, self.addr, msg, prefix, trace)
+
+
+class BusPublisher(DatagramProtocol):
+    """The poller side of the bus"""
+
+    def __init__(self, reactor=None, snapshot_dir=None):
+        self.reactor = reactor
+        self.snapshot_dir = snapshot_dir
+        self.parsers = {}
+        # Last time each emitter address subscribed, by repo
+        self.subscribers = {}
+        # One ReplyPublisher per (repo, addr), so the parsers can gather the
+        # issue lookups of each emitter
+        self.reply_publishers = {}
+        # The feed events kept for replay as (number, datagram), by repo
+        self.backlog = {}
+        # The address and last received event number, by (repo, channel)
+        self.channels = {}
+        self.acked = {}
+        # Event numbers are only meaningful within one run of the poller
+        self.session = repr(time.time())
+        self.next_number = 0
+
+    def add_repo(self, repo):
+        """Start watching events for repo and publish them"""
+        # Imported here, so emitter processes don't load the web client
+        from github_events import GithubArchiveEventsParser
+        parser = GithubArchiveEventsParser(
+            repo, self.reactor, RepoPublisher(self, repo), self.snapshot_dir
+        )
+        self.parsers[repo] = parser
+        self.subscribers[repo] = {}
+        self.backlog[repo] = deque(maxlen=BACKLOG_SIZE)
+        parser.watch_for_events()
+        parser.warm_up()
+
+    def datagramReceived(self, data, addr):
+        try:
+            request = json.loads(data)
+            request_type = request['type']
+            repo = request['repo']
+            if not isinstance(repo, basestring):
+                raise TypeError('repo must be a string')
+            if request_type == 'subscribe':
+                channel = request['channel']
+                if not isinstance(channel, basestring):
+                    raise TypeError('channel must be a string')
+                last_number = None
+                if request['last_seq'] is not None:
+                    session, number = request['last_seq']
+                    if session == self.session:
+                        last_number = int(number)
+            elif request_type == 'issue':
+                issue_number = int(request['number'])
+            elif request_type == 'issues':
+                if not isinstance(request['numbers'], list):
+                    raise TypeError('numbers must be a list')
+                issue_numbers = [int(number) for number in request['numbers']]
+        except (ValueError, KeyError, TypeError):
+            log.debug("Bad datagram {data} from {addr}", data=repr(data), addr=addr)
+            return
+
+        if repo not in self.parsers:
+            log.debug("Request for unknown repo {repo} from {addr}", repo=repo, addr=addr)
+            return
+
+        if request_type == 'subscribe':
+            self.subscribe(repo, channel, addr, last_number)
+        elif request_type == 'issue':
+            self.parsers[repo].show_issue(
+                issue_number, chatbot=self.reply_publisher(repo, addr)
+            )
+        elif request_type == 'issues':
+            self.parsers[repo].show_issues(
+                issue_numbers, chatbot=self.reply_publisher(repo, addr)
+            )
+        else:
+            log.debug("Unknown request type {type}", type=request_type)
+
+    def subscribe(self, repo, channel, addr, last_number):
+        """(Re-)subscribe the emitter for channel at addr to repo
+
+        last_number is the number of the last feed event the emitter got in
+        this session of the poller, or None if it doesn't know.
+        """
+        key = (repo, channel)
+        if last_number is not None:
+            self.acked[key] = max(last_number, self.acked.get(key, -1))
+        self._expire(repo)
+
+        # A new address for the channel, e.g. after a restart of the emitter
+        old_addr = self.channels.get(key)
+        if old_addr is not None and old_addr != addr:
+            self._forget(repo, old_addr)
+        self.channels[key] = addr
+
+        if addr not in self.subscribers[repo]:
+            log.info("{addr} subscribed to {repo} for {channel}",
+                     addr=addr, repo=repo, channel=channel)
+            # Send what the channel missed, everything kept if it is unknown
+            replay_after = self.acked.get(key, -1)
+            for number, datagram in self.backlog[repo]:
+                if number > replay_after:
+                    self.transport.write(datagram, addr)
+        self.subscribers[repo][addr] = time.time()
+
+    def _forget(self, repo, addr):
+        """Forget the emitter at addr for repo"""
+        self.subscribers[repo].pop(addr, None)
+        self.reply_publishers.pop((repo, addr), None)
+
+    def _expire(self, repo):
+        """Forget the emitters for repo that have not subscribed in time"""
+        now = time.time()
+        for addr, last_seen in list(self.subscribers[repo].items()):
+            if now - last_seen > SUBSCRIBER_TIMEOUT:
+                log.info("{addr} timed out from {repo}", addr=addr, repo=repo)
+                self._forget(repo, addr)
+
+    def reply_publisher(self, repo, addr):
+        """Return the ReplyPublisher for the emitter at addr"""
+        key = (repo, addr)
+        if key not in self.reply_publishers:
+            self.reply_publishers[key] = ReplyPublisher(self, repo, addr)
+        return self.reply_publishers[key]
+
+    def _datagram(self, repo, msg, prefix, trace, seq=None):
+        return json.dumps({
+            'type': 'message', 'repo': repo, 'msg': msg, 'prefix': prefix,
+            'trace': trace.to_dict() if trace is not None else None,
+            'seq': seq,
+        })
+
+    def reply(self, repo, addr, msg, prefix='', trace=None):
+        """Send a message to the emitter at addr only"""
+        self.transport.write(self._datagram(repo, msg, prefix, trace), addr)
+
+    def publish(self, repo, msg, prefix='', trace=None):
+        """Send a message to all live subscribers of repo and keep it"""
+        number = self.next_number
+        self.next_number += 1
+        datagram = self._datagram(repo, msg, prefix, trace, [self.session, number])
+        self.backlog[repo].append((number, datagram))
+        self._expire(repo)
+        for addr in self.subscribers[repo]:
+            self.transport.write(datagram, addr)
+
+
+class BusSubscriber(DatagramProtocol):
+    """The IRC emitter side of the bus
+
+    Takes the place of the event parser on the chatbot, so the chatbot
+    can request issues with show_issue as usual.
+    """
+
+    def __init__(self, repo, channel, host, port):
+        self.repo = repo
+        self.channel = channel
+        # The seq of the last feed event received
+        self.last_seq = None
+        # Resolved, since datagrams are sent to and compared with IP addresses
+        self.address = (socket.gethostbyname(host), port)
+        self.chatbot = None
+        # Messages received while the chatbot is not connected
+        self.pending = deque(maxlen=100)
+        self.subscribe_loop = LoopingCall(self.subscribe)
+
+    def startProtocol(self):
+        self.subscribe_loop.start(SUBSCRIBE_INTERVAL)
+
+    def stopProtocol(self):
+        if self.subscribe_loop.running:
+            self.subscribe_loop.stop()
+
+    def attach(self, chatbot):
+        """Deliver messages to chatbot, starting with the pending ones"""
+        self.chatbot = chatbot
+        while self.pending:
+            msg, prefix, trace = self.pending.popleft()
+            chatbot.send_multiline_msg(msg, prefix, trace)
+
+    def detach(self):
+        """Stop delivering messages, e.g. when the connection is lost"""
+        self.chatbot = None
+
+    def _send(self, request):
+        request['repo'] = self.repo
+        self.transport.write(json.dumps(request), self.address)
+
+    def subscribe(self):
+        """(Re-)subscribe to the repo at the poller"""
+        self._send({
+            'type': 'subscribe', 'channel': self.channel, 'last_seq': self.last_seq
+        })
+
+    def show_issue(self, issue_number, in_detail=False):
+        """Ask the poller to look up an issue"""
+        self._send({'type': 'issue', 'number': issue_number})
+
+    def show_issues(self, issue_numbers):
+        """Ask the poller to look up several issues"""
+        self._send({'type': 'issues', 'numbers': issue_numbers})
+
+    def datagramReceived(self, data, addr):
+        if addr != self.address:
+            log.debug("Ignoring datagram from {addr}", addr=addr)
+            return
+        try:
+            message = json.loads(data)
+            msg, prefix = message['msg'], message['prefix']
+            trace = message.get('trace')
+            if trace is not None:
+                trace = EventTrace.from_dict(trace)
+            seq = message.get('seq')
+        except (ValueError, KeyError, TypeError):
+            log.debug("Bad datagram {data} from {addr}", data=repr(data), addr=addr)
+            return
+
+        if self.chatbot is None:
+            self.pending.append((msg, prefix, trace))
+        else:
+            self.chatbot.send_multiline_msg(msg, prefix, trace)
+
+        # Let the poller know the feed event got here
+        if seq is not None:
+            self.last_seq = seq
+            self.subscribe()
+
+
+def main_poller(port, repos):
+    """Run a poller process, publishing events for repos on port"""
+    import os
+    import sys
+    from twisted.internet import reactor
+    from twisted.logger import textFileLogObserver, globalLogBeginner
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
+    # The warm state is kept between runs in EVENT_SNAPSHOT_DIR
+    publisher = BusPublisher(reactor, os.environ.get('EVENT_SNAPSHOT_DIR'))
+    reactor.listenUDP(port, publisher, interface='127.0.0.1')
+    for repo in repos:
+        reactor.callWhenRunning(publisher.add_repo, repo)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    import sys
+    main_poller(int(sys.argv[1]), sys.argv[2:])
@@ -0,0 +1,155 @@
+"""Latency tracing of github events, from github to the IRC channel
+
+Each event from the feed carries an EventTrace, which collects the time
+the event was created on github, when the poll fetched it, when it was
+formatted, when it was enqueued for sending and when each of its lines
+was sent. Completed traces go to a TraceLog, which writes them as JSON
+lines to a file and keeps the recent ones for statistics. Traces of
+events that never reach the channel, e.g. because the connection was
+lost, are written as dropped and counted, but not used for statistics.
+"""
+
+from __future__ import print_function
+
+import calendar
+import json
+import time
+from collections import deque
+
+from twisted.logger import Logger
+
+log = Logger(namespace="TRACE")
+
+# The latency segments of an event and the timestamps that delimit them.
+# The handoff is the time from the parser to the line queue of the bot,
+# e.g. waiting for the channel to be joined or passing over the bus
+SEGMENTS = (
+    ('github', 'created', 'fetched'),
+    ('format', 'fetched', 'formatted'),
+    ('handoff', 'formatted', 'enqueued'),
+    ('queue', 'enqueued', 'first_sent'),
+    ('send', 'first_sent', 'last_sent'),
+    ('total', 'created', 'last_sent'),
+)
+
+
+def parse_github_time(timestamp):
+    """Turn a github timestamp like 2016-05-01T12:34:56Z into epoch seconds"""
+    if timestamp is None:
+        return None
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    """Nearest rank percentiles of values"""
+    values = sorted(values)
+    if not values:
+        return dict((point, None) for point in points)
+    result = {}
+    for point in points:
+        rank = max(1, int(round(point / 100.0 * len(values))))
+        result[point] = values[rank - 1]
+    return result
+
+
+class EventTrace(object):
+    """Timestamps of one event on its way from github to IRC"""
+
+    def __init__(self, event_id, event_type, created, fetched,
+                 formatted=None, enqueued=None, lines=0, sent=None, dropped=None):
+        self.event_id = event_id
+        self.event_type = event_type
+        self.created = created
+        self.fetched = fetched
+        self.formatted = formatted
+        self.enqueued = enqueued
+        self.lines = lines
+        self.sent = sent or []
+        # The reason the event never reached the channel, if it didn't
+        self.dropped = dropped
+
+    def to_dict(self):
+        """Return the trace as a dict, e.g. for sending it on the bus"""
+        return {
+            'event_id': self.event_id, 'event_type': self.event_type,
+            'created': self.created, 'fetched': self.fetched,
+            'formatted': self.formatted, 'enqueued': self.enqueued,
+            'lines': self.lines, 'sent': self.sent, 'dropped': self.dropped,
+        }
+
+    @classmethod
+    def from_dict(cls, trace_dict):
+        """Recreate a trace from to_dict output"""
+        return cls(**trace_dict)
+
+    def line_sent(self, when):
+        """Register that a line was sent, return whether all lines are"""
+        self.sent.append(when)
+        return len(self.sent) >= self.lines
+
+    def segments(self):
+        """Return the duration of each latency segment, None if unknown"""
+        times = self.to_dict()
+        times['first_sent'] = self.sent[0] if self.sent else None
+        times['last_sent'] = self.sent[-1] if self.sent else None
+        segments = {}
+        for name, start, end in SEGMENTS:
+            if times[start] is None or times[end] is None:
+                segments[name] = None
+            else:
+                segments[name] = times[end] - times[start]
+        return segments
+
+
+class TraceLog(object):
+    """Sink for completed traces"""
+
+    def __init__(self, path=None, size=200):
+        self.path = path
+        self.recent = deque(maxlen=size)
+        self.dropped = 0
+
+    def _write(self, record):
+        if self.path is not None:
+            with open(self.path, 'a') as file_:
+                file_.write(json.dumps(record) + '\n')
+
+    def complete(self, trace):
+        """Record a completed trace"""
+        record = trace.to_dict()
+        record['segments'] = trace.segments()
+        self.recent.append(record['segments'])
+        log.debug("Event {event_id} traced {segments}",
+                  event_id=trace.event_id, segments=record['segments'])
+        self._write(record)
+
+    def drop(self, trace, reason):
+        """Record a trace of an event that will never reach the channel"""
+        if trace.dropped is not None:
+            return
+        trace.dropped = reason
+        self.dropped += 1
+        log.debug("Event {event_id} dropped: {reason}",
+                  event_id=trace.event_id, reason=reason)
+        self._write(trace.to_dict())
+
+    def summary(self):
+        """Return a short summary of the latency percentiles of recent traces"""
+        dropped = ''
+        if self.dropped:
+            dropped = ', {} events dropped'.format(self.dropped)
+        if not self.recent:
+            return 'No events traced yet' + dropped
+        parts = []
+        for name, _, _ in SEGMENTS:
+            values = [segments[name] for segments in self.recent
+                      if segments[name] is not None]
+            if not values:
+                continue
+            result = percentiles(values, (50, 90, 100))
+            parts.append('{} {:.1f}/{:.1f}/{:.1f}'.format(
+                name, result[50], result[90], result[100]
+            ))
+        return 'Latency in s (p50/p90/max) over {} events: {}{}'.format(
+            len(self.recent), ', '.join(parts), dropped
+        )
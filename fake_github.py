@@ -0,0 +1,141 @@
+"""Local fake github, for checking the issue lookups of the events parser
+
+Serves single issues and the GraphQL endpoint for a fake repository on a
+local port and counts the requests. Runs the issue lookup scenarios of
+GithubArchiveEventsParser against it and reports, for each, the number of
+requests made and the number of lines replied.
+
+Run with:
+
+    python fake_github.py
+
+The exit code is 1 if any scenario did not give the expected numbers.
+"""
+
+from __future__ import print_function
+
+import json
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+from twisted.web import resource, server
+
+from github_events import GithubArchiveEventsParser
+
+REPO = 'owner/repo'
+# The issue numbers that exist in the fake repository
+ISSUES = range(1, 31)
+
+
+def fake_issue(number):
+    """Return the REST API information about a fake issue"""
+    return {
+        'number': number, 'title': 'Issue number {}'.format(number),
+        'state': 'open' if number % 2 else 'closed', 'labels': [],
+        'user': {'login': 'author{}'.format(number)},
+        'html_url': 'https://github.com/{}/issues/{}'.format(REPO, number),
+    }
+
+
+class FakeGithub(resource.Resource):
+    """The github API for the fake repository"""
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append(request.path)
+        prefix = '/repos/{}/issues/'.format(REPO)
+        if request.path.startswith(prefix):
+            number = int(request.path[len(prefix):])
+            if number in ISSUES:
+                return json.dumps(fake_issue(number))
+        request.setResponseCode(404)
+        return json.dumps({'message': 'Not Found'})
+
+    def render_POST(self, request):
+        self.requests.append(request.path)
+        query = json.loads(request.content.read())['query']
+        repository = {}
+        # The queries look like: i12: issueOrPullRequest(number: 12) { ... }
+        for part in query.split('issueOrPullRequest(number: ')[1:]:
+            number = int(part.split(')', 1)[0])
+            info = None
+            if number in ISSUES:
+                info = dict((key, fake_issue(number)[key])
+                            for key in ('number', 'title', 'state'))
+                info['state'] = info['state'].upper()
+            repository['i{}'.format(number)] = info
+        return json.dumps({'data': {'repository': repository}})
+
+
+class ReplyCollector(object):
+    """Stand-in for the chatbot, that collects the replied lines"""
+
+    def __init__(self):
+        self.lines = []
+
+    def send_multiline_msg(self, msg, prefix='', trace=None):
+        self.lines.extend(msg.split('\n'))
+
+
+@defer.inlineCallbacks
+def run_scenario(api_url, fake_github, name, messages, token, expected):
+    """Look up the issues referenced in messages and check the numbers
+
+    expected is a tuple of the number of requests and of reply lines. All
+    referenced issues must also be in the reply.
+    """
+    chatbot = ReplyCollector()
+    parser = GithubArchiveEventsParser(REPO, reactor, chatbot, api_url=api_url)
+    parser.token = token
+    parser.issue_batch_window = 0.05
+    del fake_github.requests[:]
+    for issue_numbers in messages:
+        parser.show_issues(issue_numbers)
+    yield deferLater(reactor, 0.5, lambda: None)
+
+    result = (len(fake_github.requests), len(chatbot.lines))
+    reply = '\n'.join(chatbot.lines)
+    ok = result == expected and all(
+        '#{}'.format(number) in reply
+        for issue_numbers in messages for number in issue_numbers
+    )
+    print('{:<40} {:>8} {:>6} {:>9}'.format(
+        name, result[0], result[1], 'ok' if ok else 'FAILED'
+    ))
+    defer.returnValue(ok)
+
+
+@defer.inlineCallbacks
+def main(reactor_):
+    """Run all scenarios and print a report"""
+    fake_github = FakeGithub()
+    port = reactor.listenTCP(0, server.Site(fake_github), interface='127.0.0.1')
+    api_url = 'http://127.0.0.1:{}'.format(port.getHost().port)
+
+    print('{:<40} {:>8} {:>6} {:>9}'.format('scenario', 'requests', 'lines', 'result'))
+    print('-' * 66)
+    scenarios = [
+        ('single reference', [[7]], None, (1, 1)),
+        ('4 references without token', [[12, 15, 19, 22]], None, (4, 1)),
+        ('4 references with token', [[12, 15, 19, 22]], 'token', (1, 1)),
+        ('references from 2 messages', [[12, 15], [15, 19]], 'token', (1, 1)),
+        ('12 references, batches of 10', [range(1, 13)], 'token', (2, 3)),
+        ('missing issues without token', [[3, 99]], None, (2, 1)),
+    ]
+    results = []
+    for name, messages, token, expected in scenarios:
+        result = yield run_scenario(api_url, fake_github, name, messages, token, expected)
+        results.append(result)
+    yield port.stopListening()
+    if not all(results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    from twisted.internet.task import react
+    react(main)
@@ -3,22 +3,27 @@
 from __future__ import print_function
 
 from time import sleep
+import os
 import re
 import socket
+import time
+from io import BytesIO
 from pprint import pprint, pformat
 import json
 
-from twisted.web.client import Agent, readBody
+from twisted.internet.defer import DeferredList, succeed
+from twisted.web.client import Agent, FileBodyProducer, readBody
 from twisted.web.http_headers import Headers
 from twisted.logger import textFileLogObserver, globalLogBeginner, Logger
 from twisted.words.protocols.irc import assembleFormattedText
 from twisted.words.protocols.irc import attributes as A
 
+from event_trace import EventTrace, parse_github_time
+
 # Color alias
 fg = A.fg
 
 log = Logger(namespace="EVENTS")
-log.info("events")
 
 
 FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
@@ -29,9 +34,12 @@ def camel_to_snake(string):
     return ALL_CAP_RE.sub(r'\1_\2', string).lower()
 
 
-SOCK = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
+SOCK = None
 def send_to_irc(text):
+    global SOCK
+    if SOCK is None:
+        SOCK = socket.socket(socket.AF_INET, # Internet
+                             socket.SOCK_DGRAM) # UDP
     SOCK.sendto(text, ('localhost', 9999))
 
 
@@ -88,6 +96,9 @@ class GithubArchiveEventsParser(object):
             '{state} ', fg.yellow['{type} #{number}'], A.bold[' "{title}" '], 'by ',
             fg.lightGreen['{author}'], '{labels} ', fg.lightBlue['{html_url}']
         ],
+        'requested_issues_component': [
+            fg.yellow['#{number}'], A.bold[' "{title}" '], '{state}'
+        ],
         'release_event': [
             ' -=# ', fg.lightGreen['{author}'], ' just release version ',
             fg.yellow['{release_name}'], A.bold[' \o/\o/\o/' ], ' #=-\n',
@@ -127,21 +138,140 @@ class GithubArchiveEventsParser(object):
         'opened': 'green',
         'closed': 'lightRed',
     }
-
-    def __init__(self, repo, reactor=None, chatbot=None):
+    state_colors = {
+        'open': '\x0303',
+        'closed': '\x0304',
+    }
+    # Issue references are gathered for this many seconds and then looked
+    # up together, at most issue_batch_size of them
+    issue_batch_window = 1.0
+    issue_batch_size = 10
+    # GraphQL fields for both issues and pull requests in a batch lookup
+    issue_batch_fields = 'number title state'
+    # Issues are answered from the cache for this many seconds. Only the
+    # fields used in the replies are cached
+    issue_cache_max_age = 600
+    issue_cache_fields = (
+        'number', 'title', 'state', 'labels', 'author', 'html_url', 'pull_request'
+    )
+    # At most this many new events are shown from one poll, e.g. after a
+    # restart, the rest are only counted
+    max_replayed_events = 5
+
+    def __init__(self, repo, reactor=None, chatbot=None, snapshot_dir=None,
+                 api_url='https://api.github.com'):
         self.repo = repo
         _, self.repo_name = repo.split('/')
         self.reactor = reactor
         self.chatbot = chatbot
         self.last_known_id = None
-
-        self.feed_link = "https://api.github.com/repos/{}/events?per_page=100".format(repo)
-        self.issue_link = "https://api.github.com/repos/{}/issues/{{}}".format(repo)
+        # Issue information by issue number (as a string), with fetch time
+        self.issue_cache = {}
+
+        # api_url can point at a local fake github, see fake_github.py
+        self.feed_link = "{}/repos/{}/events?per_page=100".format(api_url, repo)
+        self.issue_link = "{}/repos/{}/issues/{{}}".format(api_url, repo)
+        self.issues_link = (
+            "{}/repos/{}/issues?state=all&sort=updated&per_page=100"
+            .format(api_url, repo)
+        )
+        self.graphql_link = "{}/graphql".format(api_url)
         self.headers = {'User-Agent': ['Github chat bot']}
+        # The GraphQL API, used for batched issue lookups, requires a token
+        self.token = os.environ.get('GITHUB_TOKEN')
+        # Issue numbers gathered for a batch lookup, by who to reply to
+        self.pending_issues = {}
         self.agent = None
         if reactor:
             self.agent = Agent(reactor)
 
+        # The warm state from the last run is kept in a snapshot file
+        self.snapshot_path = None
+        if snapshot_dir is not None:
+            self.snapshot_path = os.path.join(
+                snapshot_dir, repo.replace('/', '_') + '.json'
+            )
+            self.load_snapshot()
+
+    def load_snapshot(self):
+        """Load the last known event id and issue cache from the snapshot"""
+        # Anything unexpected, e.g. a snapshot from an older version, means
+        # a cold start
+        try:
+            with open(self.snapshot_path) as file_:
+                snapshot = json.load(file_)
+            last_known_id = snapshot['last_known_id']
+            issue_cache = {}
+            for number, cached in snapshot['issue_cache'].items():
+                info = dict((field, cached['info'][field])
+                            for field in self.issue_cache_fields)
+                issue_cache[str(number)] = {
+                    'fetched': float(cached['fetched']), 'info': info
+                }
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            log.debug("No usable snapshot at {path}", path=self.snapshot_path)
+            return
+        self.last_known_id = last_known_id
+        self.issue_cache.update(issue_cache)
+        log.debug("Loaded snapshot from {path}", path=self.snapshot_path)
+
+    def save_snapshot(self):
+        """Save the last known event id and issue cache to the snapshot"""
+        if self.snapshot_path is None:
+            return
+        # Drop the stale issues, so the snapshot doesn't grow forever
+        now = time.time()
+        for number, cached in list(self.issue_cache.items()):
+            if now - cached['fetched'] > self.issue_cache_max_age:
+                del self.issue_cache[number]
+        snapshot = {
+            'last_known_id': self.last_known_id,
+            'issue_cache': self.issue_cache,
+        }
+        # Write to a temporary file first, so a crash never leaves half a
+        # snapshot. The snapshot is only an optimization, so failing to
+        # write it must not stop the bot
+        temporary_path = self.snapshot_path + '.tmp'
+        try:
+            with open(temporary_path, 'w') as file_:
+                json.dump(snapshot, file_)
+            os.rename(temporary_path, self.snapshot_path)
+        except (IOError, OSError) as exception:
+            log.debug("Could not save snapshot to {path}: {exception}",
+                      path=self.snapshot_path, exception=exception)
+
+    def cache_issue(self, info):
+        """Put the information about an issue from the REST API in the cache
+
+        Returns the cached information, which has the labels as a list of
+        names, the login of the author as author and pull_request as a bool.
+        """
+        cached = {
+            'number': info['number'],
+            'title': info['title'],
+            'state': info['state'],
+            'labels': [label['name'] for label in info['labels']],
+            'author': info['user']['login'],
+            'html_url': info['html_url'],
+            'pull_request': 'pull_request' in info,
+        }
+        self.issue_cache[str(info['number'])] = {'fetched': time.time(), 'info': cached}
+        return cached
+
+    def forget_issues(self, event):
+        """Drop the issue or pull request an event may change from the cache"""
+        payload = event.get('payload') or {}
+        for key in ('issue', 'pull_request'):
+            if isinstance(payload.get(key), dict):
+                self.issue_cache.pop(str(payload[key].get('number')), None)
+
+    def cached_issue(self, issue_number):
+        """Return the cached information about an issue or None if not fresh"""
+        cached = self.issue_cache.get(str(issue_number))
+        if cached is None or time.time() - cached['fetched'] > self.issue_cache_max_age:
+            return None
+        return cached['info']
+
     def _extract_info_dict(self, event_dict):
         """Extract information from event dict into flat dict"""
         info_dict = {'repo_name': self.repo_name}
@@ -199,6 +329,13 @@ class GithubArchiveEventsParser(object):
         else:
             info_dict.update({'emoji': ':('})
 
+    def colored_state(self, state):
+        """Return the title cased state, colored if it is open or closed"""
+        state = state.lower()
+        if state in self.state_colors:
+            return self.state_colors[state] + state.title() + '\x03'
+        return state.title()
+
     def handle_action_colors(self, info_dict, color_template):
         """Change the color templates to accommodate action colors"""
         for index in range(len(color_template)):
@@ -256,37 +393,58 @@ class GithubArchiveEventsParser(object):
     def body_received_callback(self, body, polling_interval, etag):
         """Body received callback"""
         log.debug("Got body")
+        # Schedule the next poll first, so nothing below can stop the polling
+        log.debug("call again later after appropriate polling intervall "
+                  "{pol_int}", pol_int=polling_interval)
+        self.reactor.callLater(polling_interval, self.watch_for_events, etag)
+        fetched = self.reactor.seconds()
         events = json.loads(body)
+        if not events:
+            return
 
-        # This is the first time ever
-        if self.last_known_id is None:
-            self.act_on_event(events[0])
+        # This is the first time ever, or we have been away for so long that
+        # the last known event is no longer in the feed
+        known_ids = [event['id'] for event in events]
+        if self.last_known_id not in known_ids:
+            new_events = [events[0]]
         else:
-            seen_last_known = False
-            for event in reversed(events):
-                if seen_last_known:
-                    self.act_on_event(event)
-                elif event['id'] == self.last_known_id:
-                    seen_last_known = True
-            
-        log.debug("reponse parsed, call again later after appropriate polling "
-                  "intervall {pol_int}", pol_int=polling_interval)
-        self.reactor.callLater(polling_interval, self.watch_for_events, etag)
+            new_events = list(reversed(events[:known_ids.index(self.last_known_id)]))
+
+        # Only show the latest events, so a long absence doesn't flood the channel
+        skipped = new_events[:-self.max_replayed_events]
+        if skipped:
+            for event in skipped:
+                self.forget_issues(event)
+            self.last_known_id = skipped[-1]['id']
+            message = "... and {} more events on github, that I'll skip".format(len(skipped))
+            self.chatbot.send_multiline_msg(message)
+        for event in new_events[-self.max_replayed_events:]:
+            self.act_on_event(event, fetched)
+        self.save_snapshot()
 
     def body_received_errback(self, failure, *args, **kwargs):
         """Body received error back"""
         log.debug("Body received error back. THIS SHOULD NOT HAPPEN")
         log.debug(str(failure))
 
-    def act_on_event(self, event):
-        """Act on an event"""
+    def act_on_event(self, event, fetched=None):
+        """Act on an event, fetched is the time the poll received it
+
+        The trace times are taken from the reactor, like the times the
+        chatbot enqueues and sends lines, so they always share one clock.
+        """
         self.last_known_id = event['id']
+        trace = EventTrace(
+            event['id'], event['type'], parse_github_time(event.get('created_at')),
+            fetched or self.reactor.seconds(),
+        )
 
         # Form the event name, extract relevant information into the info_dict, fetch and
         # possibly customize color template
         event_type = camel_to_snake(event['type'])
         log.debug("Event type: {event_type}", event_type=event_type)
         info_dict = self._extract_info_dict(event)
+        self.forget_issues(event)
         color_template = self.templates.get(
             event_type, self.templates['default_event']
         )
@@ -306,11 +464,54 @@ class GithubArchiveEventsParser(object):
         pprint(template)
         pprint(info_dict)
         formatted_msg = template.format(**info_dict)
-        self.chatbot.send_multiline_msg(formatted_msg)
+        trace.formatted = self.reactor.seconds()
+        self.chatbot.send_multiline_msg(formatted_msg, trace=trace)
         
-    def show_issue(self, issue_number, in_detail=False):
-        """Get information about an issue"""
+    def warm_up(self):
+        """Fill the issue cache with the recently updated issues"""
+        log.debug("Warm up issue cache")
+        d = self.agent.request(
+            'GET',
+            self.issues_link,
+            Headers(self.headers),
+            None,
+        )
+        d.addCallback(self.warm_up_callback)
+        d.addErrback(self.warm_up_errback)
+
+    def warm_up_callback(self, response):
+        """Callback for when the recently updated issues has been retrieved"""
+        if response.code != 200:
+            log.debug("error getting the issues to warm up {code}", code=response.code)
+            return
+        d = readBody(response)
+        d.addCallback(self.warm_up_body_received_callback)
+        d.addErrback(self.warm_up_errback)
+
+    def warm_up_body_received_callback(self, body):
+        """Warm up body received callback"""
+        issues = json.loads(body)
+        for info in issues:
+            self.cache_issue(info)
+        log.debug("Warmed up issue cache with {count} issues", count=len(issues))
+        self.save_snapshot()
+
+    def warm_up_errback(self, failure, *args, **kwargs):
+        """Error back for the warm up, which is only an optimization"""
+        log.debug("Warm up error back")
+        log.debug(str(failure))
+
+    def show_issue(self, issue_number, in_detail=False, chatbot=None):
+        """Get information about an issue
+
+        The reply goes to chatbot, by default the chatbot of the parser.
+        """
         log.debug("Show issue {issue}", issue=issue_number)
+        chatbot = chatbot or self.chatbot
+        cached = self.cached_issue(issue_number)
+        if cached is not None:
+            self.send_issue(cached, chatbot)
+            return
         headers = {'User-Agent': ['dGithub chat bot']}
         d = self.agent.request(
             'GET',
@@ -318,10 +519,10 @@ class GithubArchiveEventsParser(object):
             Headers(headers),
             None,
         )
-        d.addCallback(self.issue_request_callback, issue_number)
-        d.addErrback(self.issue_request_errback)
+        d.addCallback(self.issue_request_callback, issue_number, chatbot)
+        d.addErrback(self.issue_request_errback, chatbot)
         
-    def issue_request_callback(self, response, issue_number):
+    def issue_request_callback(self, response, issue_number, chatbot):
         """Callback for when the feed has been retrived"""
         log.debug("request callback")
 
@@ -330,43 +531,211 @@ class GithubArchiveEventsParser(object):
         if response.code != 200:
             log.debug("error getting the issue {issue} {code}", issue=issue_number, code=response.code)
             message = "Fetching issue information fails right now, try again later"
-            self.chatbot.send_multiline_msg(message)
+            chatbot.send_multiline_msg(message)
             return
 
         d = readBody(response)
-        d.addCallback(self.issue_body_received_callback)
-        d.addErrback(self.issue_request_errback)
+        d.addCallback(self.issue_body_received_callback, chatbot)
+        d.addErrback(self.issue_request_errback, chatbot)
 
-    def issue_body_received_callback(self, body):
+    def issue_body_received_callback(self, body, chatbot):
         """Body received callback"""
         log.debug("Got body")
-        info = json.loads(body)
+        info = self.cache_issue(json.loads(body))
+        self.send_issue(info, chatbot)
+
+    def send_issue(self, info, chatbot):
+        """Send the detailed message about an issue, info as from cache_issue"""
+        info = dict(info)
         if info['labels']:
-            label_names = (label['name'] for label in info['labels'])
-            info['labels'] = ' ({})'.format(', '.join(label_names))
+            info['labels'] = ' ({})'.format(', '.join(info['labels']))
         else:
             info['labels'] = ''
-        info['type'] = "pull request" if 'pull_request' in info else "issue"
-        info['author'] = info['user']['login']
-        for state, color in (("open", "\x0303"), ("closed", "\x0304")):
-            if state == info['state']:
-                info['state'] = color + info['state'].title() + '\x03'
-                break
-        else:
-            info['state'] = info['state'].title()
+        info['type'] = "pull request" if info['pull_request'] else "issue"
+        info['state'] = self.colored_state(info['state'])
         color_template = assembleFormattedText(
             A.normal[self.templates['requested_issue']]
         )
         formatted_msg = color_template.format(**info)
         
-        self.chatbot.send_multiline_msg(formatted_msg)
+        chatbot.send_multiline_msg(formatted_msg)
 
-    def issue_request_errback(self, failure, *args, **kwargs):
+    def issue_request_errback(self, failure, chatbot):
         """Error back for when an issue request fails"""
         log.debug("Issue request error back")
         #log.err(failure)
         message = "Fetching issue information fails right now, try again later"
-        self.chatbot.send_multiline_msg(message)
+        chatbot.send_multiline_msg(message)
+
+    def show_issues(self, issue_numbers, chatbot=None):
+        """Get summary information about several issues
+
+        The issue numbers are gathered for issue_batch_window seconds, so
+        that references from several messages can be looked up together.
+        The reply goes to chatbot, by default the chatbot of the parser, and
+        only references with the same chatbot are gathered together. A
+        single reference, with nothing gathered, is shown right away.
+        """
+        chatbot = chatbot or self.chatbot
+        if len(issue_numbers) == 1 and chatbot not in self.pending_issues:
+            self.show_issue(issue_numbers[0], chatbot=chatbot)
+            return
+        if chatbot not in self.pending_issues:
+            self.pending_issues[chatbot] = []
+            self.reactor.callLater(self.issue_batch_window, self.flush_issues, chatbot)
+        pending = self.pending_issues[chatbot]
+        for issue_number in issue_numbers:
+            if issue_number not in pending:
+                pending.append(issue_number)
+
+    def flush_issues(self, chatbot):
+        """Look up the issues gathered for chatbot in one request"""
+        pending = self.pending_issues.pop(chatbot)
+        issue_numbers = pending[:self.issue_batch_size]
+        # Look up the rest in the next batch
+        if pending[self.issue_batch_size:]:
+            self.pending_issues[chatbot] = pending[self.issue_batch_size:]
+            self.reactor.callLater(self.issue_batch_window, self.flush_issues, chatbot)
+        log.debug("Show issues {issues}", issues=issue_numbers)
+
+        # Single issues get the detailed message, if all are cached, no
+        # request is needed and without a token there is no batch API, so
+        # fall back to one request per issue, but still one summary
+        cached = [self.cached_issue(issue_number) for issue_number in issue_numbers]
+        if len(issue_numbers) == 1:
+            self.show_issue(issue_numbers[0], chatbot=chatbot)
+            return
+        if all(info is not None for info in cached):
+            self.send_issues_summary(issue_numbers, cached, chatbot)
+            return
+        if self.token is None:
+            self.fetch_issues(issue_numbers, chatbot)
+            return
+
+        owner, name = self.repo.split('/')
+        fields = self.issue_batch_fields
+        issue_queries = [
+            'i{0}: issueOrPullRequest(number: {0}) {{ '
+            '... on Issue {{ {1} }} ... on PullRequest {{ {1} }} }}'
+            .format(int(issue_number), fields)
+            for issue_number in issue_numbers
+        ]
+        query = 'query {{ repository(owner: {}, name: {}) {{ {} }} }}'.format(
+            json.dumps(owner), json.dumps(name), ' '.join(issue_queries)
+        )
+        headers = {
+            'User-Agent': ['Github chat bot'],
+            'Authorization': ['bearer ' + self.token],
+        }
+        body = FileBodyProducer(BytesIO(json.dumps({'query': query}).encode('utf-8')))
+        d = self.agent.request(
+            'POST',
+            self.graphql_link,
+            Headers(headers),
+            body,
+        )
+        d.addCallback(self.issues_request_callback, issue_numbers, chatbot)
+        d.addErrback(self.issue_request_errback, chatbot)
+
+    def issues_request_callback(self, response, issue_numbers, chatbot):
+        """Callback for when the batch issue request returns"""
+        log.debug("issues request callback")
+
+        if response.code != 200:
+            log.debug("error getting the issues {issues} {code}", issues=issue_numbers, code=response.code)
+            message = "Fetching issue information fails right now, try again later"
+            chatbot.send_multiline_msg(message)
+            return
+
+        d = readBody(response)
+        d.addCallback(self.issues_body_received_callback, issue_numbers, chatbot)
+        d.addErrback(self.issue_request_errback, chatbot)
+
+    def issues_body_received_callback(self, body, issue_numbers, chatbot):
+        """Batch issue body received callback, sends one compact summary"""
+        log.debug("Got issues body")
+        try:
+            repository = json.loads(body)['data']['repository']
+            issues = [repository['i{}'.format(int(number))] for number in issue_numbers]
+        except (ValueError, KeyError, TypeError):
+            log.debug("Bad issues body {body}", body=body)
+            message = "Fetching issue information fails right now, try again later"
+            chatbot.send_multiline_msg(message)
+            return
+        self.send_issues_summary(issue_numbers, issues, chatbot)
+
+    def fetch_issues(self, issue_numbers, chatbot):
+        """Look up issues with one REST request each and send one summary"""
+        deferreds = []
+        for issue_number in issue_numbers:
+            cached = self.cached_issue(issue_number)
+            if cached is not None:
+                deferreds.append(succeed(cached))
+                continue
+            d = self.agent.request(
+                'GET',
+                self.issue_link.format(issue_number),
+                Headers(self.headers),
+                None,
+            )
+            d.addCallback(self.fetch_issue_callback, issue_number)
+            deferreds.append(d)
+        d = DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(self.fetch_issues_callback, issue_numbers, chatbot)
+
+    def fetch_issue_callback(self, response, issue_number):
+        """Callback for one issue of fetch_issues, None if it does not exist"""
+        if response.code == 404:
+            return None
+        if response.code != 200:
+            raise ValueError(
+                'Error getting issue {} {}'.format(issue_number, response.code)
+            )
+        d = readBody(response)
+        d.addCallback(self.fetch_issue_body_received_callback)
+        return d
+
+    def fetch_issue_body_received_callback(self, body):
+        """Body received callback for one issue of fetch_issues"""
+        return self.cache_issue(json.loads(body))
+
+    def fetch_issues_callback(self, results, issue_numbers, chatbot):
+        """Callback for when all issues of fetch_issues are retrieved"""
+        if not all(success for success, _ in results):
+            log.debug("error getting the issues {issues}", issues=issue_numbers)
+            message = "Fetching issue information fails right now, try again later"
+            chatbot.send_multiline_msg(message)
+            return
+        issues = [info for _, info in results]
+        self.send_issues_summary(issue_numbers, issues, chatbot)
+
+    def send_issues_summary(self, issue_numbers, issues, chatbot):
+        """Send one compact summary of several issues"""
+        color_template = assembleFormattedText(
+            A.normal[self.templates['requested_issues_component']]
+        )
+        summaries = []
+        for issue_number, info in zip(issue_numbers, issues):
+            if not info:
+                summaries.append('#{} not found'.format(issue_number))
+                continue
+            title = info['title'].strip().encode('ascii', 'ignore').decode('ascii')
+            if len(title) > 40:
+                title = title[:37] + '...'
+            summaries.append(color_template.format(
+                number=info['number'], title=title,
+                state=self.colored_state(info['state']),
+            ))
+
+        # Pack the summaries into as few lines as possible, to use as
+        # little of the send throttle as possible
+        lines = []
+        for summary in summaries:
+            if lines and len(lines[-1]) + len(summary) < 300:
+                lines[-1] += ', ' + summary
+            else:
+                lines.append(summary)
+        chatbot.send_multiline_msg('\n'.join(lines))
         
     ## Test archive parsing
     def test_get_archive_events(self):
@@ -0,0 +1,255 @@
+"""Simulated clock benchmark of the PelsBot send throttle
+
+Replays burst scenarios against PelsBot._send_line on a
+twisted.internet.task.Clock and an in-memory IRC transport, so no IRC
+server is needed and a run takes milliseconds. For each scenario it
+reports the enqueue-to-send latency percentiles per line, the number of
+lines that broke the throttle policy (more than 5 lines in 10 s, with
+less than 1 s since the previous line) and the number of times
+_send_line woke up.
+
+Run with:
+
+    python throttle_bench.py
+
+The exit code is 1 if any scenario broke the throttle policy.
+"""
+
+from __future__ import print_function
+
+import sys
+from collections import defaultdict, deque
+from Queue import Queue
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from chatbot import PelsBot, PelsBotFactory
+from event_trace import percentiles
+
+CHANNEL = '#bench'
+BURST_SIZE = 5
+BURST_WINDOW = 10
+THROTTLED_INTERVAL = 1
+
+
+class RecordingTransport(StringTransport):
+    """In-memory transport that records when each channel line was written"""
+
+    def __init__(self, clock):
+        StringTransport.__init__(self)
+        self.clock = clock
+        self.sent = []
+        self.lost = []
+
+    def write(self, data):
+        StringTransport.write(self, data)
+        for line in data.split('\r\n'):
+            if not line.startswith('PRIVMSG ' + CHANNEL):
+                continue
+            msg = line.split(' :', 1)[1]
+            if self.disconnecting:
+                self.lost.append((self.clock.seconds(), msg))
+            else:
+                self.sent.append((self.clock.seconds(), msg))
+
+
+class TimedQueue(Queue):
+    """Line queue that records when each line was enqueued"""
+
+    def __init__(self, clock, enqueued):
+        Queue.__init__(self)
+        self.clock = clock
+        self.enqueued = enqueued
+
+    def _put(self, item):
+        line, _ = item
+        self.enqueued[line].append(self.clock.seconds())
+        Queue._put(self, item)
+
+
+class NullBus(object):
+    """Event source for the bot that never produces anything by itself"""
+
+    def attach(self, chatbot):
+        pass
+
+    def detach(self):
+        pass
+
+    def show_issue(self, issue_number, in_detail=False):
+        pass
+
+    def show_issues(self, issue_numbers):
+        pass
+
+
+class BenchBot(PelsBot):
+    """PelsBot that times its queue and counts send loop wake ups"""
+
+    wakeups = 0
+
+    def _send_line(self):
+        # Swap in a queue that records enqueue times, keeping the lines
+        # queued by joined
+        if not isinstance(self.line_queue, TimedQueue):
+            line_queue = TimedQueue(self.factory.reactor, self.factory.enqueued)
+            while self.line_queue.qsize():
+                line_queue.put(self.line_queue.get())
+            self.line_queue = line_queue
+        BenchBot.wakeups += 1
+        PelsBot._send_line(self)
+
+
+class Scenario(object):
+    """A simulated IRC session, with scheduled actions on a Clock"""
+
+    def __init__(self, name):
+        self.name = name
+        self.clock = Clock()
+        self.factory = PelsBotFactory(
+            CHANNEL, 'owner/repo', 'BenchBot', NullBus(), self.clock
+        )
+        self.factory.protocol = BenchBot
+        self.factory.enqueued = self.enqueued = defaultdict(deque)
+        self.transports = []
+        self.bot = None
+
+    def connect(self):
+        """Connect and join a new bot, like after a (re)connect"""
+        self.bot = self.factory.buildProtocol(None)
+        transport = RecordingTransport(self.clock)
+        self.transports.append(transport)
+        self.bot.makeConnection(transport)
+        self.bot.joined(CHANNEL)
+
+    def disconnect(self):
+        """Drop the connection of the current bot"""
+        self.bot.transport.loseConnection()
+        self.bot.connectionLost(None)
+
+    def events(self, count, first=0):
+        """Enqueue count one line events, as the event parser would"""
+        for number in range(first, first + count):
+            self.bot.send_multiline_msg('event {}'.format(number))
+
+    def user_command(self, user):
+        """A user says hi to the bot"""
+        self.bot.command_hi(user, 'hi')
+
+    def at(self, when, method, *args):
+        """Schedule method on the simulated clock"""
+        self.clock.callLater(when, method, *args)
+
+    def run(self, until):
+        """Run the clock until the given simulated time"""
+        BenchBot.wakeups = 0
+        while self.clock.seconds() < until:
+            calls = self.clock.getDelayedCalls()
+            if not calls:
+                break
+            next_call = min(call.getTime() for call in calls)
+            self.clock.advance(max(0, min(next_call, until) - self.clock.seconds()))
+        return self.report(until)
+
+    def report(self, duration):
+        """Collect the numbers for the scenario"""
+        latencies = []
+        enqueued = dict((line, deque(times)) for line, times in self.enqueued.items())
+        violations = 0
+        for transport in self.transports:
+            sent_times = []
+            for sent_time, msg in transport.sent:
+                if enqueued.get(msg):
+                    latencies.append(sent_time - enqueued[msg].popleft())
+            # Lines written to a dead connection are neither sent nor pending
+            for _, msg in transport.lost:
+                if enqueued.get(msg):
+                    enqueued[msg].popleft()
+            for sent_time, _ in transport.sent:
+                if (len(sent_times) >= BURST_SIZE and
+                        sent_time - sent_times[-BURST_SIZE] <= BURST_WINDOW and
+                        sent_time - sent_times[-1] < THROTTLED_INTERVAL):
+                    violations += 1
+                sent_times.append(sent_time)
+
+        return {
+            'name': self.name,
+            'enqueued': sum(len(times) for times in self.enqueued.values()),
+            'sent': sum(len(transport.sent) for transport in self.transports),
+            'lost': sum(len(transport.lost) for transport in self.transports),
+            'unsent': sum(len(times) for times in enqueued.values()),
+            'latencies': percentiles(latencies),
+            'violations': violations,
+            'wakeups': BenchBot.wakeups,
+            'wakeups_per_s': BenchBot.wakeups / float(duration),
+        }
+
+
+def scenario_backlog():
+    """100 events arrive at once, e.g. the first poll after a long outage"""
+    scenario = Scenario('backlog of 100 events')
+    scenario.connect()
+    scenario.at(1, scenario.events, 100)
+    return scenario.run(300)
+
+
+def scenario_interleaved():
+    """Users talk to the bot while a backlog is being sent"""
+    scenario = Scenario('backlog with user commands')
+    scenario.connect()
+    scenario.at(1, scenario.events, 100)
+    for number, when in enumerate((2, 5, 10, 30, 60, 61, 62)):
+        scenario.at(when, scenario.user_command, 'user{}'.format(number))
+    return scenario.run(300)
+
+
+def scenario_reconnect():
+    """The connection drops while a backlog is being sent"""
+    scenario = Scenario('reconnect during backlog')
+    scenario.connect()
+    scenario.at(1, scenario.events, 50)
+    scenario.at(15, scenario.disconnect)
+    scenario.at(20, scenario.connect)
+    scenario.at(21, scenario.events, 50, 50)
+    return scenario.run(300)
+
+
+def scenario_idle():
+    """Nothing happens, only the join message is sent"""
+    scenario = Scenario('idle')
+    scenario.connect()
+    return scenario.run(300)
+
+
+SCENARIOS = [scenario_backlog, scenario_interleaved, scenario_reconnect, scenario_idle]
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.2f}'.format(value)
+
+
+def main():
+    """Run all scenarios and print a report"""
+    failed = False
+    header = ('{:<28} {:>5} {:>5} {:>5} {:>6} {:>7} {:>7} {:>7} {:>7} {:>5} {:>8}'
+              .format('scenario', 'queue', 'sent', 'lost', 'unsent', 'p50 s',
+                      'p90 s', 'p99 s', 'max s', 'viol', 'wakeup/s'))
+    print(header)
+    print('-' * len(header))
+    for scenario in SCENARIOS:
+        result = scenario()
+        latencies = result['latencies']
+        print('{:<28} {:>5} {:>5} {:>5} {:>6} {:>7} {:>7} {:>7} {:>7} {:>5} {:>8.1f}'.format(
+            result['name'], result['enqueued'], result['sent'], result['lost'],
+            result['unsent'], format_seconds(latencies[50]),
+            format_seconds(latencies[90]), format_seconds(latencies[99]),
+            format_seconds(latencies[100]), result['violations'],
+            result['wakeups_per_s'],
+        ))
+        failed = failed or result['violations'] > 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())